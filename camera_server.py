@@ -1,24 +1,259 @@
 #!/usr/bin/env python3
 import asyncio
 import cv2
-import json
+import multiprocessing
+import numpy as np
+import orjson
 import os
+import queue
+import shutil
+import sys
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
-from collections import deque
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from multiprocessing import shared_memory
+from urllib.parse import urlparse
 from loguru import logger
 from aiohttp import web
 
 from shinobi_client import ShinobiClient
 from onvif_events import ONVIFManager
+from video_io import (RollingSegmentCache, drop_page_cache, open_video_capture, open_video_writer,
+                      probe_encoder)
+
+# One OpenCV worker thread per call: with one reader/writer pair per camera,
+# per-call thread pools sized to the core count only fight each other
+cv2.setNumThreads(1)
+
+def _new_segment_pool():
+    # 'spawn' avoids forking a process that already runs reader/writer threads
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn'))
+
+
+# Shared by all cameras so pre-event encodes run in parallel across CPU cores.
+# Replaced if a worker dies (e.g. OOM-killed), which breaks the whole pool.
+_SEGMENT_POOL = _new_segment_pool()
+_segment_pool_lock = threading.Lock()
+
+
+def _submit_segment_job(fn, *args):
+    """Submit work to _SEGMENT_POOL, restarting the pool if it has broken"""
+    global _SEGMENT_POOL
+    with _segment_pool_lock:
+        try:
+            return _SEGMENT_POOL.submit(fn, *args)
+        except BrokenProcessPool:
+            logger.warning("Pre-event encoder pool broke, restarting it")
+            _SEGMENT_POOL.shutdown(wait=False)
+            _SEGMENT_POOL = _new_segment_pool()
+            return _SEGMENT_POOL.submit(fn, *args)
+
+
+def _shm_free_bytes():
+    """Free space in /dev/shm, or None where shared memory isn't backed by it"""
+    try:
+        st = os.statvfs('/dev/shm')
+    except (AttributeError, OSError):
+        return None
+    return st.f_bavail * st.f_frsize
+
+
+def _write_metadata(metadata_file, metadata):
+    """Write a recording's JSON sidecar"""
+    try:
+        with open(metadata_file, 'wb') as f:
+            f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
+    except FileNotFoundError:
+        # The hour directory was removed under us (e.g. by cleanup_recordings
+        # while still empty), so the recording itself is lost too
+        _forget_recording_dir(os.path.dirname(metadata_file))
+        raise
+
+
+# (base_dir, camera_id) -> ((year, month, day, hour), directory), so the hour
+# directory is only formatted and created when the hour rolls over
+_recording_dir_cache = {}
+
+
+def _recording_path(base_dir, camera_id, prefix, start_time):
+    """Build <base_dir>/<camera>/<date>/<hour>/<prefix>_<H-M-S>.mp4, creating the directory"""
+    local = time.localtime(start_time)
+    hour_key = local[:4]
+
+    cached = _recording_dir_cache.get((base_dir, camera_id))
+    if cached is not None and cached[0] == hour_key:
+        recording_dir = cached[1]
+    else:
+        date_dir = time.strftime("%Y-%m-%d", local)
+        hour_dir = time.strftime("%H", local)
+        recording_dir = os.path.join(base_dir, camera_id, date_dir, hour_dir)
+        os.makedirs(recording_dir, exist_ok=True)
+        _recording_dir_cache[(base_dir, camera_id)] = (hour_key, recording_dir)
+
+    filename = f"{prefix}_{local.tm_hour:02d}-{local.tm_min:02d}-{local.tm_sec:02d}.mp4"
+    return os.path.join(recording_dir, filename)
+
+
+def _forget_recording_dir(recording_dir):
+    """Drop a cached hour directory that has disappeared, so the next path recreates it"""
+    for key, (hour_key, cached_dir) in list(_recording_dir_cache.items()):
+        if cached_dir == recording_dir:
+            _recording_dir_cache.pop(key, None)
+
+
+def _write_pre_event_metadata(filepath, camera_id, config, trigger_time):
+    """Write the sidecar for a saved pre-event clip"""
+    metadata = {
+        'camera_id': camera_id,
+        'type': 'pre_event',
+        'start_time': trigger_time - config['pre_event_buffer'],
+        'end_time': trigger_time,
+        'duration': config['pre_event_buffer'],
+        'file': os.path.basename(filepath)
+    }
+    _write_metadata(filepath.replace('.mp4', '.json'), metadata)
+
+
+def _encode_pre_event_frames(frames, camera_id, config, trigger_time, encoder):
+    """Encode a (count, H, W, 3) pre-event buffer into a clip and write its sidecar"""
+    filepath = _recording_path(config['base_dir'], camera_id, 'pre_event', trigger_time)
+
+    # Convert buffer to video
+    height, width = frames.shape[1:3]
+    out = open_video_writer(filepath, 30, (width, height), config.get('bitrate', '4M'),
+                            profile='event', encoder=encoder)
+    for i in range(frames.shape[0]):
+        out.write(frames[i])
+    out.release()
+
+    if config.get('drop_page_cache', True):
+        drop_page_cache(filepath)
+
+    # Save metadata
+    _write_pre_event_metadata(filepath, camera_id, config, trigger_time)
+
+    return filepath
+
+
+def _save_pre_event_buffer_mp(frames_shm_name, shape, dtype, camera_id, config, trigger_time, encoder):
+    """Encode a pre-event buffer staged in shared memory (runs in _SEGMENT_POOL)"""
+    # The parent owns the block and unlinks it once this returns
+    shm = shared_memory.SharedMemory(name=frames_shm_name)
+    try:
+        frames = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        try:
+            return _encode_pre_event_frames(frames, camera_id, config, trigger_time, encoder)
+        finally:
+            # Drop the view so the shared memory can be closed
+            del frames
+    finally:
+        shm.close()
+
+
+# Seconds between attempts to restart a segment cache whose ffmpeg has exited
+SEGMENT_CACHE_RESTART_INTERVAL = 10
+
+
+def _json_response(data, status=200):
+    """JSON response serialized with orjson"""
+    return web.Response(body=orjson.dumps(data), status=status, content_type='application/json')
+
+
+class FrameRing:
+    """Rolling frame buffer backed by one pre-allocated (capacity, H, W, 3) array"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ring = None
+        self.head = 0  # next slot to write
+        self.full = False
+
+    def __len__(self):
+        return self.capacity if self.full else self.head
+
+    @property
+    def frame_shape(self):
+        return self.ring.shape[1:]
+
+    def push(self, frame):
+        """Copy a frame into the ring, overwriting the oldest one once full"""
+        if self.ring is None or self.ring.shape[1:] != frame.shape:
+            # Allocated on the first frame, and again if the resolution changes
+            self.ring = np.empty((self.capacity,) + frame.shape, dtype=np.uint8)
+            self.head = 0
+            self.full = False
+        np.copyto(self.ring[self.head], frame)
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+            self.full = True
+
+    def copy_to(self, out):
+        """Copy the newest len(out) frames into out, oldest first"""
+        # Safe while another thread pushes: the copy starts at the oldest slot and
+        # runs far faster than the frame rate, so it stays ahead of overwrites
+        ring, head, n = self.ring, self.head, len(out)
+        start = (head - n) % self.capacity
+        if start < head:
+            np.copyto(out, ring[start:head])
+        else:
+            first = self.capacity - start
+            np.copyto(out[:first], ring[start:])
+            np.copyto(out[first:], ring[:head])
+
+
+class JpegFrameRing:
+    """Rolling frame buffer holding JPEG-encoded frames, ~10-20x smaller than raw BGR"""
+
+    def __init__(self, capacity, quality=85):
+        self.capacity = capacity
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self.ring = [None] * capacity
+        self.shape = None
+        self.head = 0  # next slot to write
+        self.full = False
+
+    def __len__(self):
+        return self.capacity if self.full else self.head
+
+    @property
+    def frame_shape(self):
+        return self.shape
+
+    def push(self, frame):
+        """Encode a frame into the ring, overwriting the oldest one once full"""
+        ok, jpg = cv2.imencode('.jpg', frame, self.params)
+        if not ok:
+            return
+        if self.shape != frame.shape:
+            # Frames of the old resolution can't be staged alongside the new ones
+            self.ring = [None] * self.capacity
+            self.shape = frame.shape
+            self.head = 0
+            self.full = False
+        self.ring[self.head] = jpg
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+            self.full = True
+
+    def copy_to(self, out):
+        """Decode the newest len(out) frames into out, oldest first"""
+        ring, head, n = self.ring, self.head, len(out)
+        start = (head - n) % self.capacity
+        for i in range(n):
+            out[i] = cv2.imdecode(ring[(start + i) % self.capacity], cv2.IMREAD_COLOR)
+
 
 class StreamProcessor:
-    def __init__(self, camera_id, rtsp_url, recording_config):
+    def __init__(self, camera_id, rtsp_url, recording_config, reader_cpu=None):
         self.camera_id = camera_id
         self.rtsp_url = rtsp_url
         self.config = recording_config
+        # CPU to pin the reader thread to (None = let the scheduler decide)
+        self.reader_cpu = reader_cpu
 
         # Recording state
         self.is_recording = False
@@ -27,18 +262,48 @@ class StreamProcessor:
 
         # Buffers
         # Reduce buffer size for lower RAM usage (e.g., 10 seconds at 10 FPS)
-        self.frame_buffer = deque(maxlen=int(10 * 10))  # 10 seconds at 10 FPS
+        # With pre_event_jpeg_quality set, frames are kept JPEG-encoded and only
+        # decoded when an event saves them
+        jpeg_quality = self.config.get('pre_event_jpeg_quality')
+        if jpeg_quality:
+            self.frame_buffer = JpegFrameRing(int(10 * 10), jpeg_quality)
+        else:
+            self.frame_buffer = FrameRing(int(10 * 10))  # 10 seconds at 10 FPS
+        # With pre_event_source 'segments', ffmpeg keeps the pre-event history on disk
+        # as stream-copied segments instead; the in-memory buffer is only filled
+        # while that ffmpeg isn't running
+        self.segment_cache = None
+        if self.config.get('pre_event_source', 'memory') == 'segments':
+            if shutil.which('ffmpeg'):
+                cache_dir = os.path.join(self.config['base_dir'], self.camera_id, '.pre_event_cache')
+                self.segment_cache = RollingSegmentCache(rtsp_url, cache_dir, self.config['pre_event_buffer'])
+            else:
+                logger.warning(f"ffmpeg not found, camera {camera_id} buffers pre-event frames in memory")
+        # Event frames go into a ring allocated on the first event frame
+        # (max 10 seconds at 30 FPS); event_write_idx counts frames written
+        self.max_event_frames = 300
+        self.event_ring = None
+        self.event_write_idx = 0
         self.segment_start_time = None
         self.video_writer = None
         self.segment_file_path = None
+        self._next_writer_future = None
 
-        # Threading
+        # Threading (stages pre-event buffers for _SEGMENT_POOL)
         self.executor = ThreadPoolExecutor(max_workers=2)
+        # Opens and closes segment writers off the writer thread; separate from the
+        # executor above so a slow pre-event save can't hold up a segment boundary
+        self.segment_executor = ThreadPoolExecutor(max_workers=2)
+        self._submitted = 0
+        self._completed = 0
         self.running = False
 
         # Limit FPS to 30 FPS for recording
         self.max_fps = 30
 
+        # Max frames queued between pipeline stages (back-pressure on the reader)
+        self.prefetch = 8
+
     async def start_processing(self):
         """Start processing the RTSP stream"""
         self.running = True
@@ -46,19 +311,15 @@ class StreamProcessor:
 
         while self.running:
             try:
-                logger.info(f"Opening RTSP stream for camera {self.camera_id}: {self.rtsp_url}")
+                # (Re)start the segment cache if it isn't running
+                if self.segment_cache is not None:
+                    self.segment_cache.start()
 
-                # Use ffmpeg options for hardware decoding if supported
-                # OpenCV does not allow direct passing of ffmpeg options, but you can try appending options to the URL
-                # Example: 'rtsp_transport;tcp' or use ffmpeg directly for full control
-
-                # If you want full GPU decoding, consider using ffmpeg via subprocess:
-                # ffmpeg -hwaccel cuda -c:v h264_cuvid -i <rtsp_url> ...
+                logger.info(f"Opening RTSP stream for camera {self.camera_id}: {self.rtsp_url}")
 
-                cap = cv2.VideoCapture(self.rtsp_url, cv2.CAP_FFMPEG)
-                # If you have OpenCV >= 4.5.1, you can set options:
-                # cap.set(cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, 5000)
-                # cap.set(cv2.CAP_PROP_READ_TIMEOUT_MSEC, 5000)
+                # Request hardware decoding (NVDEC/VAAPI/...) through PyAV or OpenCV
+                cap = open_video_capture(self.rtsp_url, self.config.get('decoder', 'opencv'),
+                                         self.config.get('hwaccel'))
 
                 if not cap.isOpened():
                     logger.error(f"Failed to open RTSP stream for camera {self.camera_id} (URL: {self.rtsp_url})")
@@ -68,79 +329,183 @@ class StreamProcessor:
                 fps = cap.get(cv2.CAP_PROP_FPS) or 30
                 # Limit FPS to max_fps
                 fps = min(fps, self.max_fps)
-                frame_interval = 1.0 / fps
 
                 logger.info(f"Started processing camera {self.camera_id} at {fps} FPS")
 
-                self.segment_start_time = time.time()
-                first_frame = None
-
-                while self.running and cap.isOpened():
-                    start_time = time.time()
-
-                    ret, frame = cap.read()
-                    if not ret:
-                        logger.warning(f"Failed to read frame from camera {self.camera_id} (URL: {self.rtsp_url})")
-                        break
+                # Reader thread -> this coroutine -> writer thread, so decoding the next
+                # frame overlaps with encoding the previous one. The reader hands frames
+                # to the loop directly, so awaiting one doesn't hold an executor thread;
+                # read_slots bounds how many are in flight. The RTSP source paces the loop.
+                stop_event = threading.Event()
+                read_q = asyncio.Queue()
+                read_slots = threading.BoundedSemaphore(self.prefetch)
+                write_q = queue.Queue(maxsize=self.prefetch)
+                reader = threading.Thread(target=self._reader_loop,
+                                          args=(cap, fps, loop, read_q, read_slots, stop_event), daemon=True)
+                writer = threading.Thread(target=self._writer_loop, args=(fps, write_q), daemon=True)
+                reader.start()
+                writer.start()
+
+                frame_count = 0
+                try:
+                    while self.running:
+                        item = await read_q.get()
+                        if item is None:
+                            break
+                        read_slots.release()
+                        timestamp, frame = item
+
+                        # Log executor backlog every 300 frames (~10 s at 30 FPS); plain counters,
+                        # unlike _work_queue.qsize() which takes the queue's lock
+                        frame_count += 1
+                        if frame_count % 300 == 0:
+                            logger.debug(f"Executor backlog for camera {self.camera_id}: {self._submitted - self._completed}")
+
+                        # Handle event recording (still uses buffer)
+                        await self._handle_event_recording(frame, timestamp)
+
+                        # Hand off to the writer thread, only waiting when it is backed up
+                        try:
+                            write_q.put_nowait(frame)
+                        except queue.Full:
+                            await loop.run_in_executor(None, write_q.put, frame)
+                finally:
+                    stop_event.set()
+                    await loop.run_in_executor(None, self._join_pipeline, reader, writer, write_q)
+                    cap.release()
 
-                    # On first frame, start the segment writer with correct size
-                    if first_frame is None:
-                        first_frame = frame
-                        self._start_new_segment_writer(fps, frame)
-
-                    # Add to rolling buffer
-                    self.frame_buffer.append((time.time(), frame))
-
-                    # Write frame directly to disk for continuous recording
-                    if self.video_writer is not None:
-                        self.video_writer.write(frame)
-                        # Explicitly delete frame reference
-                        del frame
-
-                    # Log ThreadPoolExecutor queue size
-                    logger.info(f"ThreadPoolExecutor queue size: {self.executor._work_queue.qsize()}")
+            except Exception as e:
+                logger.error(f"Error processing camera {self.camera_id}: {e}")
+                await asyncio.sleep(5)
 
-                    # Check if segment is complete (1 minute)
-                    if time.time() - self.segment_start_time >= self.config['segment_duration']:
-                        self._close_segment_writer()
-                        self.segment_start_time = time.time()
-                        first_frame = None  # Reset for next segment
+    def _reader_loop(self, cap, fps, loop, read_q, read_slots, stop_event):
+        """Read frames from the stream into read_q until it ends or the pipeline stops"""
+        # Live RTSP streams pace themselves through cap.read(); other sources (files)
+        # are paced against a monotonic deadline so scheduler jitter doesn't accumulate
+        if self.reader_cpu is not None:
+            try:
+                # On Linux pid 0 means the calling thread, so only the reader is pinned
+                os.sched_setaffinity(0, {self.reader_cpu})
+            except OSError as e:
+                logger.warning(f"Failed to pin reader for camera {self.camera_id} to CPU {self.reader_cpu}: {e}")
+
+        pace = not self.rtsp_url.lower().startswith(('rtsp://', 'rtsps://'))
+        frame_interval_ns = int(1e9 / fps)
+        next_tick = time.monotonic_ns()
+        segment_cache = self.segment_cache
+        next_segment_restart = 0
+        try:
+            while self.running and not stop_event.is_set():
+                ret, frame = cap.read()
+                if not ret:
+                    logger.warning(f"Failed to read frame from camera {self.camera_id} (URL: {self.rtsp_url})")
+                    break
+                timestamp = time.time()
+
+                # Add to rolling buffer here so JPEG encoding stays off the event loop.
+                # The segment cache replaces it only while its ffmpeg is running.
+                if segment_cache is None or not segment_cache.is_running():
+                    self.frame_buffer.push(frame)
+                    if segment_cache is not None and time.monotonic() >= next_segment_restart:
+                        logger.warning(f"Segment cache for camera {self.camera_id} is not running, "
+                                       f"restarting it (pre-event frames are buffered in memory meanwhile)")
+                        segment_cache.start()
+                        next_segment_restart = time.monotonic() + SEGMENT_CACHE_RESTART_INTERVAL
+
+                if not self._acquire_until_stopped(read_slots, stop_event):
+                    break
+                loop.call_soon_threadsafe(read_q.put_nowait, (timestamp, frame))
+
+                if pace:
+                    next_tick += frame_interval_ns
+                    sleep_ns = next_tick - time.monotonic_ns()
+                    if sleep_ns > 0:
+                        time.sleep(sleep_ns / 1e9)
+        finally:
+            # Wake up the consumer; the sentinel doesn't need a slot
+            try:
+                loop.call_soon_threadsafe(read_q.put_nowait, None)
+            except RuntimeError:
+                # Event loop already closed
+                pass
+
+    @staticmethod
+    def _acquire_until_stopped(slots, stop_event):
+        """Wait for a free read_q slot; False once the pipeline has been stopped"""
+        while not stop_event.is_set():
+            if slots.acquire(timeout=0.5):
+                return True
+        return False
+
+    def _writer_loop(self, fps, write_q):
+        """Write frames from write_q into segment files for continuous recording"""
+        while True:
+            frame = write_q.get()
+            if frame is None:
+                break
+            try:
+                now = time.time()
 
-                    # Handle event recording (still uses buffer)
-                    await self._handle_event_recording(frame, fps)
+                # On first frame, start the segment writer with correct size
+                if self.video_writer is None:
+                    self.segment_start_time = now
+                    self._start_new_segment_writer(fps, frame)
 
-                    # Maintain frame rate
-                    elapsed = time.time() - start_time
-                    sleep_time = max(0, frame_interval - elapsed)
-                    await asyncio.sleep(sleep_time)
+                self.video_writer.write(frame)
 
-                self._close_segment_writer()
-                cap.release()
+                # Open the next segment's writer in the background near the end of
+                # this one, so the boundary doesn't stall on codec initialisation
+                elapsed = now - self.segment_start_time
+                segment_duration = self.config['segment_duration']
+                if self._next_writer_future is None and elapsed >= 0.95 * segment_duration:
+                    self._prepare_next_writer(fps, frame, self.segment_start_time + segment_duration)
 
+                # Check if segment is complete (1 minute)
+                if elapsed >= segment_duration:
+                    self._close_segment_writer(now)
             except Exception as e:
-                logger.error(f"Error processing camera {self.camera_id}: {e}")
-                await asyncio.sleep(5)
-
-    async def _handle_event_recording(self, frame, fps):
+                logger.error(f"Error writing segment for camera {self.camera_id}: {e}")
+        self._close_segment_writer(time.time())
+        self._discard_next_writer()
+
+    @staticmethod
+    def _join_pipeline(reader, writer, write_q):
+        """Wait for the reader to exit, then flush and stop the writer"""
+        reader.join()
+        write_q.put(None)
+        writer.join()
+
+    async def _handle_event_recording(self, frame, now):
         """Handle event-based recording"""
         if self.event_recording:
-            current_time = time.time()
-
-            if current_time >= self.event_end_time:
+            if now >= self.event_end_time:
                 # Event recording finished
                 self.event_recording = False
                 self.event_end_time = None
                 logger.info(f"Event recording finished for camera {self.camera_id}")
-                self.current_segment_frames = []  # Clear buffer after event
+                # Clear buffer after event
+                self.event_ring = None
+                self.event_write_idx = 0
             else:
-                # Continue recording event
-                self.current_segment_frames.append(frame)
-                # Limit event buffer size
-                if len(self.current_segment_frames) > 300:  # e.g., max 10 seconds at 30 FPS
-                    self.current_segment_frames.pop(0)
+                # Continue recording event: one memcpy into the ring, no per-frame allocation
+                if self.event_ring is None or self.event_ring.shape[1:] != frame.shape:
+                    self.event_ring = np.empty((self.max_event_frames,) + frame.shape, dtype=np.uint8)
+                    self.event_write_idx = 0
+                np.copyto(self.event_ring[self.event_write_idx % self.max_event_frames], frame)
+                self.event_write_idx += 1
                 # Log buffer size for debugging
-                if len(self.current_segment_frames) % 100 == 0:
-                    logger.info(f"event current_segment_frames size for {self.camera_id}: {len(self.current_segment_frames)}")
+                if self.event_write_idx % 100 == 0:
+                    logger.debug(f"event ring frames for {self.camera_id}: {min(self.event_write_idx, self.max_event_frames)}")
+
+    def _submit(self, fn, *args):
+        """Submit work to the executor, counting it for the backlog log"""
+        future = self.executor.submit(fn, *args)
+        self._submitted += 1
+        future.add_done_callback(self._on_task_done)
+        return future
+
+    def _on_task_done(self, future):
+        self._completed += 1
 
     def trigger_event_recording(self):
         """Trigger event recording (1 min before + during + 1 min after)"""
@@ -149,99 +514,172 @@ class StreamProcessor:
         self.event_recording = True
 
         # Save pre-event buffer
-        self.executor.submit(self._save_pre_event_buffer, current_time)
+        self._submit(self._save_pre_event_buffer, current_time)
 
         logger.info(f"Event recording triggered for camera {self.camera_id}")
 
     def _save_pre_event_buffer(self, trigger_time):
-        """Save the 1-minute pre-event buffer"""
+        """Stage the pre-event buffer in shared memory and encode it in the segment pool"""
         logger.info(f"Attempting to save pre-event buffer for camera {self.camera_id}")
+        if self.segment_cache is not None and self.segment_cache.is_running():
+            if self._export_pre_event_segments(trigger_time):
+                return
+            # Fall back to the memory ring, which holds frames from any time the
+            # segmenter was down
+            if not len(self.frame_buffer):
+                logger.error(f"No pre-event clip saved for camera {self.camera_id}: the segment "
+                             f"export failed and no frames are buffered in memory")
+                return
+            logger.warning(f"Segment export failed for camera {self.camera_id}, "
+                           f"saving the in-memory pre-event buffer instead")
+
+        shm = None
         try:
-            timestamp = datetime.fromtimestamp(trigger_time)
-            date_dir = timestamp.strftime("%Y-%m-%d")
-            hour_dir = timestamp.strftime("%H")
-
-            base_dir = os.path.join(self.config['base_dir'], self.camera_id, date_dir, hour_dir)
-            os.makedirs(base_dir, exist_ok=True)
-
-            filename = f"pre_event_{timestamp.strftime('%H-%M-%S')}.mp4"
-            filepath = os.path.join(base_dir, filename)
-
-            # Convert buffer to video
-            if self.frame_buffer:
-                frames = [frame for _, frame in self.frame_buffer]
-                height, width = frames[0].shape[:2]
-                fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-                out = cv2.VideoWriter(filepath, fourcc, 30, (width, height))
-
-                for frame in frames:
-                    out.write(frame)
-                    del frame
-                out.release()
-
-                # Save metadata
-                metadata = {
-                    'camera_id': self.camera_id,
-                    'type': 'pre_event',
-                    'start_time': trigger_time - self.config['pre_event_buffer'],
-                    'end_time': trigger_time,
-                    'duration': self.config['pre_event_buffer'],
-                    'file': filename
-                }
-
-                metadata_file = filepath.replace('.mp4', '.json')
-                with open(metadata_file, 'w') as f:
-                    json.dump(metadata, f, indent=2)
+            count = len(self.frame_buffer)
+            if not count:
+                return
+
+            shape = (count,) + self.frame_buffer.frame_shape
+            size = int(np.prod(shape))
+            free = _shm_free_bytes()
+            if free is not None and size > free:
+                # Writing past a full /dev/shm (64 MB in Docker by default) is a
+                # SIGBUS, not an exception, so encode in this thread instead
+                logger.warning(f"Not enough shared memory for the pre-event buffer of camera "
+                               f"{self.camera_id} ({size >> 20} MB needed, {free >> 20} MB free), "
+                               f"encoding it in-process")
+                frames = np.empty(shape, dtype=np.uint8)
+                self.frame_buffer.copy_to(frames)
+                filepath = _encode_pre_event_frames(frames, self.camera_id, self.config, trigger_time,
+                                                    probe_encoder())
+                logger.info(f"Saved pre-event buffer: {filepath}")
+                return
+
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            staged = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            self.frame_buffer.copy_to(staged)
+            del staged
+
+            future = _submit_segment_job(_save_pre_event_buffer_mp, shm.name, shape, 'uint8',
+                                         self.camera_id, self.config, trigger_time, probe_encoder())
+            future.add_done_callback(partial(self._on_pre_event_saved, shm))
 
+        except Exception as e:
+            logger.error(f"Failed to save pre-event buffer for camera {self.camera_id}: {e}")
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    def _export_pre_event_segments(self, trigger_time):
+        """Save the pre-event clip by stream-copying the cached segments (no re-encode); True if saved"""
+        try:
+            filepath = _recording_path(self.config['base_dir'], self.camera_id, 'pre_event', trigger_time)
+            if self.segment_cache.export(trigger_time - self.config['pre_event_buffer'], filepath):
+                _write_pre_event_metadata(filepath, self.camera_id, self.config, trigger_time)
                 logger.info(f"Saved pre-event buffer: {filepath}")
+                return True
+            if not os.path.isdir(os.path.dirname(filepath)):
+                _forget_recording_dir(os.path.dirname(filepath))
+        except Exception as e:
+            logger.error(f"Failed to save pre-event buffer for camera {self.camera_id}: {e}")
+        return False
 
+    def _on_pre_event_saved(self, shm, future):
+        """Release the staged frames once the segment pool has encoded them"""
+        shm.close()
+        shm.unlink()
+        try:
+            logger.info(f"Saved pre-event buffer: {future.result()}")
         except Exception as e:
             logger.error(f"Failed to save pre-event buffer for camera {self.camera_id}: {e}")
 
-    def _start_new_segment_writer(self, fps, frame):
-        """Start a new video writer for the next segment using the frame's size"""
-        timestamp = datetime.fromtimestamp(self.segment_start_time)
-        date_dir = timestamp.strftime("%Y-%m-%d")
-        hour_dir = timestamp.strftime("%H")
-        base_dir = os.path.join(self.config['base_dir'], self.camera_id, date_dir, hour_dir)
-        os.makedirs(base_dir, exist_ok=True)
-        filename = f"segment_{timestamp.strftime('%H-%M-%S')}.mp4"
-        self.segment_file_path = os.path.join(base_dir, filename)
+    def _build_writer(self, fps, frame_size, start_time):
+        """Create the directory, file path and video writer for a segment"""
+        segment_file_path = _recording_path(self.config['base_dir'], self.camera_id, 'segment', start_time)
+        video_writer = open_video_writer(segment_file_path, fps, frame_size, self.config.get('bitrate', '4M'))
+        return video_writer, segment_file_path
 
+    def _prepare_next_writer(self, fps, frame, next_start_time):
+        """Build the next segment's writer on the executor"""
         height, width = frame.shape[:2]
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        self.video_writer = cv2.VideoWriter(self.segment_file_path, fourcc, fps, (width, height))
+        try:
+            self._next_writer_future = self.segment_executor.submit(self._build_writer, fps, (width, height),
+                                                                    next_start_time)
+        except RuntimeError:
+            # Executor already shut down by stop(); build it at the boundary instead
+            pass
+
+    def _discard_next_writer(self):
+        """Release a prepared writer that will never receive frames"""
+        future, self._next_writer_future = self._next_writer_future, None
+        if future is None:
+            return
+        try:
+            video_writer, segment_file_path = future.result()
+            video_writer.release()
+            os.remove(segment_file_path)
+        except Exception:
+            pass
+
+    def _start_new_segment_writer(self, fps, frame):
+        """Start a new video writer for the next segment using the frame's size"""
+        future, self._next_writer_future = self._next_writer_future, None
+        if future is not None:
+            self.video_writer, self.segment_file_path = future.result()
+        else:
+            height, width = frame.shape[:2]
+            self.video_writer, self.segment_file_path = self._build_writer(fps, (width, height),
+                                                                           self.segment_start_time)
         logger.info(f"Started new segment file: {self.segment_file_path}")
 
-    def _close_segment_writer(self):
-        """Close the current video writer and save metadata"""
-        if self.video_writer is not None:
-            self.video_writer.release()
-            self.video_writer = None
+    def _close_segment_writer(self, end_time):
+        """Hand the current video writer to the segment executor to be finished"""
+        if self.video_writer is None:
+            return
+        video_writer, self.video_writer = self.video_writer, None
+        segment_file_path, self.segment_file_path = self.segment_file_path, None
+        # release() waits for ffmpeg to flush the encoder and rewrite the file for
+        # faststart (~1 s at 720p), which would stall the writer at every boundary
+        try:
+            self.segment_executor.submit(self._finish_segment, video_writer, segment_file_path,
+                                         self.segment_start_time, end_time)
+        except RuntimeError:
+            # Executor already shut down by stop(); this is the final segment
+            self._finish_segment(video_writer, segment_file_path, self.segment_start_time, end_time)
+
+    def _finish_segment(self, video_writer, segment_file_path, start_time, end_time):
+        """Close a segment's video writer and save its metadata"""
+        try:
+            video_writer.release()
             # Save metadata
             metadata = {
                 'camera_id': self.camera_id,
                 'type': 'continuous',
-                'start_time': self.segment_start_time,
-                'end_time': time.time(),
-                'duration': time.time() - self.segment_start_time,
-                'file': os.path.basename(self.segment_file_path)
+                'start_time': start_time,
+                'end_time': end_time,
+                'duration': end_time - start_time,
+                'file': os.path.basename(segment_file_path)
             }
-            metadata_file = self.segment_file_path.replace('.mp4', '.json')
-            with open(metadata_file, 'w') as f:
-                json.dump(metadata, f, indent=2)
-            logger.info(f"Closed segment file: {self.segment_file_path}")
-            self.segment_file_path = None
+            _write_metadata(segment_file_path.replace('.mp4', '.json'), metadata)
+            logger.info(f"Closed segment file: {segment_file_path}")
+
+            if self.config.get('drop_page_cache', True):
+                drop_page_cache(segment_file_path)
+        except Exception as e:
+            logger.error(f"Error closing segment {segment_file_path} for camera {self.camera_id}: {e}")
 
     async def stop(self):
         """Stop processing"""
         self.running = False
         self.executor.shutdown(wait=True)
+        self.segment_executor.shutdown(wait=True)
+        if self.segment_cache is not None:
+            self.segment_cache.stop()
 
 class CameraServer:
     def __init__(self, config_path='config.json'):
-        with open(config_path, 'r') as f:
-            self.config = json.load(f)
+        with open(config_path, 'rb') as f:
+            self.config = orjson.loads(f.read())
 
         self.shinobi = ShinobiClient(
             self.config['shinobi']['base_url'],
@@ -251,25 +689,35 @@ class CameraServer:
 
         self.onvif_manager = ONVIFManager()
         self.stream_processors = {}
+        self._shinobi_tasks = set()
+        self._event_success_bodies = {}
         self.running = False
 
         # Set up HTTP server
         self.app = web.Application()
-        self.app.router.add_post('/api/events/motion', self.handle_motion_event)
-        self.app.router.add_post('/api/events/alarm', self.handle_alarm_event)
+        self.app.router.add_post('/api/events/{kind:motion|alarm}', self._handle_event)
         self.app.router.add_get('/api/status', self.handle_status)
 
-        # Set up logging
-        logger.add("camera_server.log", rotation="1 day", retention="7 days")
+        # Set up logging; enqueue=True hands records to a background thread so
+        # logging never blocks the frame loop on a slow disk or terminal
+        logger.remove()
+        logger.add(sys.stderr, level="INFO", enqueue=True)
+        logger.add("camera_server.log", rotation="1 day", retention="7 days", level="INFO", enqueue=True)
 
     async def initialize_cameras(self):
         """Initialize all cameras and set up processors"""
-        for camera in self.config['cameras']:
+        # Optionally give each camera's reader thread its own CPU
+        cpus = None
+        if self.config['recording'].get('pin_reader_threads', False) and hasattr(os, 'sched_setaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+
+        for i, camera in enumerate(self.config['cameras']):
+            rtsp = urlparse(camera['rtsp_url'])
             monitor_config = {
                 'name': camera['name'],
-                'host': camera['rtsp_url'].split('@')[1].split(':')[0] if '@' in camera['rtsp_url'] else camera['rtsp_url'].split('//')[1].split(':')[0],
-                'port': 554,
-                'path': '/' + camera['rtsp_url'].split('/')[-1]
+                'host': rtsp.hostname,
+                'port': rtsp.port or 554,
+                'path': rtsp.path or '/'
             }
 
             # Try to add monitor to Shinobi, log result
@@ -285,7 +733,8 @@ class CameraServer:
             processor = StreamProcessor(
                 camera['id'],
                 camera['rtsp_url'],
-                self.config['recording']
+                self.config['recording'],
+                reader_cpu=cpus[i % len(cpus)] if cpus else None
             )
             self.stream_processors[camera['id']] = processor
 
@@ -294,47 +743,34 @@ class CameraServer:
 
         self.onvif_manager.set_event_callback(self._on_event_detected)
 
-    async def handle_motion_event(self, request):
-        """Handle motion event from HTTP API"""
+    async def _handle_event(self, request):
+        """Handle a motion or alarm event from HTTP API"""
+        kind = request.match_info['kind']
         try:
-            data = await request.json()
+            data = orjson.loads(await request.read())
             camera_id = data.get('camera_id')
-            
-            if camera_id in self.stream_processors:
-                self.stream_processors[camera_id].trigger_event_recording()
-                shinobi_result = await self.shinobi.trigger_event_recording(camera_id)
-                if shinobi_result:
-                    logger.info(f"Shinobi event recording triggered for {camera_id}")
-                else:
-                    logger.warning(f"Shinobi event trigger failed for {camera_id}")
-                logger.info(f"Motion event triggered via API for camera {camera_id}")
-                return web.json_response({'status': 'success', 'message': f'Motion event triggered for {camera_id}'})
-            else:
-                return web.json_response({'status': 'error', 'message': f'Camera {camera_id} not found'}, status=404)
-        except Exception as e:
-            logger.error(f"Error handling motion event: {e}")
-            return web.json_response({'status': 'error', 'message': str(e)}, status=500)
 
-    async def handle_alarm_event(self, request):
-        """Handle alarm event from HTTP API"""
-        try:
-            data = await request.json()
-            camera_id = data.get('camera_id')
-            
-            if camera_id in self.stream_processors:
-                self.stream_processors[camera_id].trigger_event_recording()
-                shinobi_result = await self.shinobi.trigger_event_recording(camera_id)
-                if shinobi_result:
-                    logger.info(f"Shinobi event recording triggered for {camera_id}")
-                else:
-                    logger.warning(f"Shinobi event trigger failed for {camera_id}")
-                logger.info(f"Alarm event triggered via API for camera {camera_id}")
-                return web.json_response({'status': 'success', 'message': f'Alarm event triggered for {camera_id}'})
+            processor = self.stream_processors.get(camera_id)
+            if processor is not None:
+                processor.trigger_event_recording()
+                self._trigger_shinobi(camera_id)
+                logger.info(f"{kind.capitalize()} event triggered via API for camera {camera_id}")
+                return web.Response(body=self._event_success_body(kind, camera_id),
+                                    content_type='application/json')
             else:
-                return web.json_response({'status': 'error', 'message': f'Camera {camera_id} not found'}, status=404)
+                return _json_response({'status': 'error', 'message': f'Camera {camera_id} not found'}, status=404)
         except Exception as e:
-            logger.error(f"Error handling alarm event: {e}")
-            return web.json_response({'status': 'error', 'message': str(e)}, status=500)
+            logger.error(f"Error handling {kind} event: {e}")
+            return _json_response({'status': 'error', 'message': str(e)}, status=500)
+
+    def _event_success_body(self, kind, camera_id):
+        """Serialized success response, built once per event kind and camera"""
+        body = self._event_success_bodies.get((kind, camera_id))
+        if body is None:
+            body = orjson.dumps({'status': 'success',
+                                 'message': f'{kind.capitalize()} event triggered for {camera_id}'})
+            self._event_success_bodies[(kind, camera_id)] = body
+        return body
 
     async def handle_status(self, request):
         """Handle status request from HTTP API"""
@@ -344,26 +780,43 @@ class CameraServer:
                 'cameras': len(self.stream_processors),
                 'camera_ids': list(self.stream_processors.keys())
             }
-            return web.json_response(status)
+            return _json_response(status)
         except Exception as e:
             logger.error(f"Error handling status request: {e}")
-            return web.json_response({'status': 'error', 'message': str(e)}, status=500)
+            return _json_response({'status': 'error', 'message': str(e)}, status=500)
 
     async def _on_event_detected(self, camera_id, event_type, event_data):
         """Handle ONVIF event detection"""
         if camera_id in self.stream_processors:
             logger.info(f"Event detected on camera {camera_id}: {event_type}")
             self.stream_processors[camera_id].trigger_event_recording()
+            self._trigger_shinobi(camera_id, ' (ONVIF)')
+
+    def _trigger_shinobi(self, camera_id, source=''):
+        """Forward an event to Shinobi without making the caller wait for it"""
+        task = asyncio.create_task(self._shinobi_trigger_and_log(camera_id, source))
+        # Keep a reference so the task isn't garbage collected mid-flight
+        self._shinobi_tasks.add(task)
+        task.add_done_callback(self._shinobi_tasks.discard)
+
+    async def _shinobi_trigger_and_log(self, camera_id, source):
+        """Trigger Shinobi event recording and log the outcome"""
+        try:
             shinobi_result = await self.shinobi.trigger_event_recording(camera_id)
             if shinobi_result:
-                logger.info(f"Shinobi event recording triggered for {camera_id} (ONVIF)")
+                logger.info(f"Shinobi event recording triggered for {camera_id}{source}")
             else:
-                logger.warning(f"Shinobi event trigger failed for {camera_id} (ONVIF)")
+                logger.warning(f"Shinobi event trigger failed for {camera_id}{source}")
+        except Exception as e:
+            logger.error(f"Error triggering Shinobi event for {camera_id}{source}: {e}")
 
     async def start_server(self):
         """Start the camera server"""
         logger.info("Starting Camera Server...")
 
+        # Probe ffmpeg encoders once so the first segment doesn't pay for it
+        await asyncio.get_running_loop().run_in_executor(None, probe_encoder)
+
         # Initialize cameras
         await self.initialize_cameras()
 
@@ -411,10 +864,18 @@ class CameraServer:
         for processor in self.stream_processors.values():
             await processor.stop()
 
+        # Wait for pending pre-event encodes
+        with _segment_pool_lock:
+            _SEGMENT_POOL.shutdown(wait=True)
+
         # Stop ONVIF monitoring
         await self.onvif_manager.stop_monitoring()
 
+        await self.shinobi.close()
+
         logger.info("Camera server stopped")
+        # Flush records still queued for the sinks
+        await logger.complete()
 async def main():
     server = CameraServer()
     await server.start_server()
@@ -11,18 +11,21 @@ Usage:
     --max-age: Maximum age in days for continuous recordings (default: 7)
 """
 
+import mmap
 import os
-import json
+import orjson
 import argparse
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from loguru import logger
 
 
 def load_config(config_path):
     """Load configuration file"""
-    with open(config_path, 'r') as f:
-        return json.load(f)
+    with open(config_path, 'rb') as f:
+        return orjson.loads(f.read())
 
 
 def get_recording_age_days(metadata):
@@ -34,27 +37,202 @@ def get_recording_age_days(metadata):
     return 0
 
 
-def should_delete(metadata, max_age_days):
+# Raw sidecar bytes that mark a recording as never deleted, matched before
+# parsing (camera_server writes sidecars with two-space indentation)
+_KEEP_MARKERS = (b'"keep": true', b'"keep":true', b'"type": "event', b'"type":"event')
+
+
+# Sidecars are read into a reusable buffer of this size; larger ones are
+# read in full, or memory-mapped from MMAP_MIN_SIZE up
+READ_BUFFER_SIZE = 8192
+MMAP_MIN_SIZE = 64 * 1024
+
+# One read buffer per sweep thread
+_read_buffers = threading.local()
+
+
+def _read_sidecar(name, dir_fd):
+    """Read a sidecar relative to dir_fd, as bytes or (for large files) an mmap"""
+    buf = getattr(_read_buffers, 'buf', None)
+    if buf is None:
+        buf = _read_buffers.buf = bytearray(READ_BUFFER_SIZE)
+    
+    fd = os.open(name, os.O_RDONLY, dir_fd=dir_fd)
+    try:
+        # Typical sidecars fit in one read, without a stat or a growing buffer
+        n = os.readv(fd, [buf])
+        if n < len(buf):
+            return bytes(memoryview(buf)[:n])
+        
+        if os.fstat(fd).st_size >= MMAP_MIN_SIZE:
+            # The page cache already holds the file; map it instead of copying it
+            return mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+        with open(fd, 'rb', closefd=False) as f:
+            return bytes(buf) + f.read()
+    finally:
+        os.close(fd)
+
+
+def should_delete(blob, cutoff_ts):
     """
-    Determine if a recording should be deleted.
+    Determine if a recording should be deleted from its raw sidecar bytes
+    (bytes or an mmap).
+    
+    Returns the parsed metadata if it should be deleted, otherwise None.
     
     Rules:
     - Never delete if 'keep' is True
     - Never delete if type starts with 'event'
-    - Delete continuous recordings older than max_age_days
+    - Delete continuous recordings that ended before cutoff_ts
     """
+    # Kept and event recordings are usually recognised without parsing at all
+    if any(blob.find(marker) != -1 for marker in _KEEP_MARKERS):
+        return None
+    
+    # Parse through a view that is released straight away, so an mmap can be closed
+    with memoryview(blob) as view:
+        metadata = orjson.loads(view)
+    
     # Never delete if explicitly marked to keep
     if metadata.get('keep', False):
-        return False
+        return None
     
     # Never delete event recordings
     rec_type = metadata.get('type', '')
     if rec_type.startswith('event'):
+        return None
+    
+    # Check age for continuous recordings (no end time counts as new)
+    end_time = metadata.get('end_time')
+    return metadata if end_time and end_time < cutoff_ts else None
+
+
+def _process_sidecar(dir_fd, dir_path, filename, cutoff_ts, dry_run, stats):
+    """Delete one recording if it is due; returns the number of files removed"""
+    video_name = filename.replace('.json', '.mp4')
+    metadata_path = os.path.join(dir_path, filename)
+    video_path = os.path.join(dir_path, video_name)
+    removed = 0
+    
+    try:
+        blob = _read_sidecar(filename, dir_fd)
+        try:
+            metadata = should_delete(blob, cutoff_ts)
+        finally:
+            if isinstance(blob, mmap.mmap):
+                blob.close()
+        if metadata is not None:
+            # Calculate size; one stat also tells whether the video exists
+            try:
+                size = os.stat(video_name, dir_fd=dir_fd).st_size
+                has_video = True
+            except FileNotFoundError:
+                size = 0
+                has_video = False
+            
+            if dry_run:
+                age_days = get_recording_age_days(metadata)
+                logger.info(f"Would delete: {video_path} "
+                           f"(type={metadata.get('type')}, "
+                           f"age={age_days:.1f} days, "
+                           f"size={size/1024/1024:.1f} MB)")
+            else:
+                # Delete video file
+                if has_video:
+                    os.unlink(video_name, dir_fd=dir_fd)
+                    removed += 1
+                # Delete metadata file
+                os.unlink(filename, dir_fd=dir_fd)
+                removed += 1
+                logger.info(f"Deleted: {video_path}")
+            
+            stats['deleted_count'] += 1
+            stats['deleted_size'] += size
+        else:
+            stats['kept_count'] += 1
+            
+    except orjson.JSONDecodeError as e:
+        logger.warning(f"Invalid JSON in {metadata_path}: {e}")
+    except Exception as e:
+        logger.error(f"Error processing {metadata_path}: {e}")
+    
+    return removed
+
+
+# Threads sweeping top-level directories in parallel; the sweep is I/O-bound
+# and the GIL is released during the syscalls
+SWEEP_WORKERS = 16
+
+
+def _sweep_subdir(parent_fd, parent_path, name, cutoff_ts, dry_run, stats):
+    """Clean up a subdirectory and remove it if left empty; returns True if removed"""
+    sub_path = os.path.join(parent_path, name)
+    try:
+        sub_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=parent_fd)
+    except OSError as e:
+        logger.error(f"Error opening {sub_path}: {e}")
         return False
+    try:
+        left = _sweep(sub_fd, sub_path, cutoff_ts, dry_run, stats)
+    finally:
+        os.close(sub_fd)
+    
+    if left == 0 and not dry_run:
+        try:
+            os.rmdir(name, dir_fd=parent_fd)
+            logger.debug(f"Removed empty directory: {sub_path}")
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def _sweep(dir_fd, dir_path, cutoff_ts, dry_run, stats, pool=None):
+    """Clean up an open directory and everything below it; returns the entries left in it"""
+    sidecars = []
+    subdirs = []
+    remaining = 0
+    # scandir on a directory fd hands back bare names, and is_dir() is answered
+    # from the dirent type without a stat
+    with os.scandir(dir_fd) as it:
+        for entry in it:
+            remaining += 1
+            if entry.name.endswith('.json'):
+                sidecars.append(entry.name)
+            elif entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+    
+    # Subdirectories first, so one left empty is removed while its parent is open
+    if pool is None:
+        for name in subdirs:
+            if _sweep_subdir(dir_fd, dir_path, name, cutoff_ts, dry_run, stats):
+                remaining -= 1
+    else:
+        # Subtrees are disjoint (one per camera), so sweep them in parallel,
+        # each with its own counters
+        jobs = []
+        for name in subdirs:
+            sub_stats = dict.fromkeys(stats, 0)
+            jobs.append((pool.submit(_sweep_subdir, dir_fd, dir_path, name, cutoff_ts, dry_run, sub_stats),
+                         sub_stats))
+        for future, sub_stats in jobs:
+            if future.result():
+                remaining -= 1
+            for key in stats:
+                stats[key] += sub_stats[key]
+    
+    for filename in sidecars:
+        # A sidecar is written when its recording ends, so one modified after the
+        # cutoff belongs to a recording that is still kept; don't even open it
+        try:
+            if os.stat(filename, dir_fd=dir_fd, follow_symlinks=False).st_mtime >= cutoff_ts:
+                stats['kept_count'] += 1
+                continue
+        except OSError:
+            pass
+        remaining -= _process_sidecar(dir_fd, dir_path, filename, cutoff_ts, dry_run, stats)
     
-    # Check age for continuous recordings
-    age_days = get_recording_age_days(metadata)
-    return age_days > max_age_days
+    return remaining
 
 
 def cleanup_recordings(base_dir, max_age_days=7, dry_run=False):
@@ -66,9 +244,7 @@ def cleanup_recordings(base_dir, max_age_days=7, dry_run=False):
         max_age_days: Maximum age in days for continuous recordings
         dry_run: If True, only report what would be deleted
     """
-    deleted_count = 0
-    deleted_size = 0
-    kept_count = 0
+    stats = {'deleted_count': 0, 'deleted_size': 0, 'kept_count': 0}
     
     logger.info(f"Starting cleanup of recordings in {base_dir}")
     logger.info(f"Max age for continuous recordings: {max_age_days} days")
@@ -78,65 +254,21 @@ def cleanup_recordings(base_dir, max_age_days=7, dry_run=False):
         logger.warning(f"Base directory does not exist: {base_dir}")
         return
     
-    # Walk through all recordings
-    for root, dirs, files in os.walk(base_dir):
-        for filename in files:
-            if not filename.endswith('.json'):
-                continue
-                
-            metadata_path = os.path.join(root, filename)
-            video_path = metadata_path.replace('.json', '.mp4')
-            
-            try:
-                with open(metadata_path, 'r') as f:
-                    metadata = json.load(f)
-                
-                if should_delete(metadata, max_age_days):
-                    # Calculate size
-                    size = 0
-                    if os.path.exists(video_path):
-                        size = os.path.getsize(video_path)
-                    
-                    age_days = get_recording_age_days(metadata)
-                    
-                    if dry_run:
-                        logger.info(f"Would delete: {video_path} "
-                                   f"(type={metadata.get('type')}, "
-                                   f"age={age_days:.1f} days, "
-                                   f"size={size/1024/1024:.1f} MB)")
-                    else:
-                        # Delete video file
-                        if os.path.exists(video_path):
-                            os.remove(video_path)
-                        # Delete metadata file
-                        os.remove(metadata_path)
-                        logger.info(f"Deleted: {video_path}")
-                    
-                    deleted_count += 1
-                    deleted_size += size
-                else:
-                    kept_count += 1
-                    
-            except json.JSONDecodeError as e:
-                logger.warning(f"Invalid JSON in {metadata_path}: {e}")
-            except Exception as e:
-                logger.error(f"Error processing {metadata_path}: {e}")
-    
-    # Clean up empty directories
-    if not dry_run:
-        for root, dirs, files in os.walk(base_dir, topdown=False):
-            for d in dirs:
-                dir_path = os.path.join(root, d)
-                try:
-                    if not os.listdir(dir_path):
-                        os.rmdir(dir_path)
-                        logger.debug(f"Removed empty directory: {dir_path}")
-                except OSError:
-                    pass
+    # Continuous recordings that ended before this are deleted
+    cutoff_ts = time.time() - max_age_days * 24 * 3600
+    
+    # One pass over all recordings: each directory stays open so files are
+    # handled relative to it, and directories emptied on the way are removed
+    base_fd = os.open(base_dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        with ThreadPoolExecutor(max_workers=SWEEP_WORKERS) as pool:
+            _sweep(base_fd, base_dir, cutoff_ts, dry_run, stats, pool)
+    finally:
+        os.close(base_fd)
     
     logger.info(f"Cleanup complete:")
-    logger.info(f"  Deleted: {deleted_count} recordings ({deleted_size/1024/1024:.1f} MB)")
-    logger.info(f"  Kept: {kept_count} recordings")
+    logger.info(f"  Deleted: {stats['deleted_count']} recordings ({stats['deleted_size']/1024/1024:.1f} MB)")
+    logger.info(f"  Kept: {stats['kept_count']} recordings")
 
 
 def main():
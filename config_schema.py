@@ -0,0 +1,43 @@
+"""
+Pydantic schema for config.json, used by test_setup.py to validate the configuration.
+"""
+
+from typing import Annotated, List
+
+from pydantic import BaseModel, ConfigDict, Field
+
+NonEmptyStr = Annotated[str, Field(min_length=1)]
+
+
+class Section(BaseModel):
+    # Only required keys are declared; optional tuning keys are allowed
+    model_config = ConfigDict(extra='allow')
+
+
+class ShinobiConfig(Section):
+    base_url: NonEmptyStr
+    api_key: NonEmptyStr
+    group_key: NonEmptyStr
+
+
+class CameraConfig(Section):
+    id: NonEmptyStr
+    name: NonEmptyStr
+    rtsp_url: NonEmptyStr
+    onvif_url: NonEmptyStr
+    username: NonEmptyStr
+    password: NonEmptyStr
+
+
+class RecordingConfig(Section):
+    base_dir: NonEmptyStr
+    segment_duration: float
+    pre_event_buffer: float
+    post_event_duration: float
+
+
+class AppConfig(Section):
+    shinobi: ShinobiConfig
+    cameras: Annotated[List[CameraConfig], Field(min_length=1)]
+    recording: RecordingConfig
+    server: dict
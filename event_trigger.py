@@ -6,16 +6,29 @@ This simulates motion detection events that would normally come from cameras.
 
 import requests
 import json
+import sys
 import time
 import argparse
+from loguru import logger
+from requests.adapters import HTTPAdapter
 
 class EventTrigger:
-    def __init__(self, camera_server_url="http://localhost:8555"):
+    def __init__(self, camera_server_url="http://localhost:8555", log_success=True):
         self.camera_server_url = camera_server_url.rstrip('/')
+        # Skip per-event success messages (e.g. in fast --interval loops)
+        self.log_success = log_success
+        self.motion_endpoint = "{}/api/events/motion".format(self.camera_server_url)
+        self.alarm_endpoint = "{}/api/events/alarm".format(self.camera_server_url)
+
+        # One keep-alive connection reused across repeated triggers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def trigger_motion_event(self, camera_id):
         """Trigger a motion detection event for a specific camera"""
-        endpoint = "{}/api/events/motion".format(self.camera_server_url)
+        endpoint = self.motion_endpoint
 
         payload = {
             "camera_id": camera_id,
@@ -28,19 +41,20 @@ class EventTrigger:
         }
 
         try:
-            response = requests.post(endpoint, json=payload, timeout=5)
+            response = self.session.post(endpoint, json=payload, timeout=5)
             response.raise_for_status()
 
-            print("✅ Motion event triggered for camera {}".format(camera_id))
+            if self.log_success:
+                logger.info("✅ Motion event triggered for camera {}", camera_id)
             return True
 
         except requests.exceptions.RequestException as e:
-            print("❌ Failed to trigger motion event: {}".format(e))
+            logger.error("❌ Failed to trigger motion event: {}", e)
             return False
 
     def trigger_alarm_event(self, camera_id, alarm_type="general"):
         """Trigger an alarm event for a specific camera"""
-        endpoint = "{}/api/events/alarm".format(self.camera_server_url)
+        endpoint = self.alarm_endpoint
 
         payload = {
             "camera_id": camera_id,
@@ -54,14 +68,15 @@ class EventTrigger:
         }
 
         try:
-            response = requests.post(endpoint, json=payload, timeout=5)
+            response = self.session.post(endpoint, json=payload, timeout=5)
             response.raise_for_status()
 
-            print("✅ Alarm event triggered for camera {} ({})".format(camera_id, alarm_type))
+            if self.log_success:
+                logger.info("✅ Alarm event triggered for camera {} ({})", camera_id, alarm_type)
             return True
 
         except requests.exceptions.RequestException as e:
-            print("❌ Failed to trigger alarm event: {}".format(e))
+            logger.error("❌ Failed to trigger alarm event: {}", e)
             return False
 
 def main():
@@ -76,14 +91,22 @@ def main():
                        help="Alarm type if event is alarm (default: general)")
     parser.add_argument("--interval", type=float, default=0,
                        help="Interval in seconds between repeated events (0 = single event)")
+    parser.add_argument("--quiet", action="store_true",
+                       help="Only report failures")
+    parser.add_argument("--verbose", action="store_true",
+                       help="Report every successful event in --interval mode")
 
     args = parser.parse_args()
 
-    trigger = EventTrigger(args.server)
+    logger.remove()
+    logger.add(sys.stdout, level="WARNING" if args.quiet else "INFO", format="{message}")
+
+    # Per-event success messages only for single events unless asked for
+    trigger = EventTrigger(args.server, log_success=args.interval == 0 or args.verbose)
 
     if args.interval > 0:
-        print("🔄 Triggering {} events for camera {} every {}s...".format(args.event, args.camera, args.interval))
-        print("Press Ctrl+C to stop")
+        logger.info("🔄 Triggering {} events for camera {} every {}s...", args.event, args.camera, args.interval)
+        logger.info("Press Ctrl+C to stop")
 
         try:
             while True:
@@ -95,7 +118,7 @@ def main():
                 time.sleep(args.interval)
 
         except KeyboardInterrupt:
-            print("\n🛑 Stopped triggering events")
+            logger.info("\n🛑 Stopped triggering events")
 
     else:
         # Single event
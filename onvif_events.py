@@ -1,17 +1,43 @@
 import asyncio
+import re
+from urllib.parse import urlsplit
 from onvif import ONVIFCamera
 from zeep import Client
 from zeep.transports import Transport
 from loguru import logger
 import time
 
+# Topics treated as motion events
+_MOTION_RE = re.compile(r'[Mm]otion|Alarm')
+
+# Standard ONVIF motion topics requested from the camera, so it only sends those.
+# Vendor-specific topics that _MOTION_RE would match can be added per camera with
+# 'onvif_topics'; an empty list subscribes to everything and filters client-side.
+DEFAULT_MOTION_TOPICS = (
+    'tns1:RuleEngine/CellMotionDetector/Motion',
+    'tns1:RuleEngine/MotionRegionDetector/Motion',
+    'tns1:VideoSource/MotionAlarm',
+)
+
+
+def _topic_filter(topics):
+    """Build a CreatePullPointSubscription filter for the given topics"""
+    return {
+        'TopicExpression': {
+            '_value_1': '|'.join(topics),
+            'Dialect': 'http://www.onvif.org/ver10/tev/topicExpression/ConcreteSet'
+        }
+    }
+
 class ONVIFEventSubscriber:
     def __init__(self, camera_config):
         self.camera_id = camera_config['id']
-        self.ip = camera_config['onvif_url'].split('//')[1].split(':')[0]
-        self.port = int(camera_config['onvif_url'].split(':')[-1].split('/')[0])
+        onvif_url = urlsplit(camera_config['onvif_url'])
+        self.ip = onvif_url.hostname
+        self.port = onvif_url.port or (443 if onvif_url.scheme == 'https' else 80)
         self.username = camera_config['username']
         self.password = camera_config['password']
+        self.topics = camera_config.get('onvif_topics', DEFAULT_MOTION_TOPICS)
         self.camera = None
         self.events_service = None
         self.pull_point_subscription = None
@@ -42,26 +68,24 @@ class ONVIFEventSubscriber:
             return False
 
         try:
-            # Create pull point subscription for events
-            subscription = self.events_service.CreatePullPointSubscription()
+            # Create pull point subscription for motion events
+            subscription = None
+            if self.topics:
+                try:
+                    subscription = self.events_service.CreatePullPointSubscription(
+                        {'Filter': _topic_filter(self.topics)})
+                except Exception as e:
+                    # Not every camera supports topic filters; match topics client-side instead
+                    logger.warning(f"Camera {self.camera_id} rejected the event filter, subscribing to all events: {e}")
+            if subscription is None:
+                subscription = self.events_service.CreatePullPointSubscription()
 
             # Get the subscription reference
             subscription_ref = subscription.SubscriptionReference.Address._value_1
 
-            # Set up event filter for motion detection
-            event_filter = {
-                'TopicExpression': {
-                    'Dialect': 'http://www.onvif.org/ver10/tev/topicExpression/ConcreteSet',
-                    'MessageContent': [
-                        'tns1:RuleEngine/CellMotionDetector/Motion',
-                        'tns1:VideoSource/MotionAlarm',
-                        'tns1:Device/Trigger/DigitalInput'
-                    ]
-                }
-            }
-
-            # Subscribe to events
-            self.pull_point_subscription = self.events_service.PullMessages(
+            # Subscribe to events (blocking SOAP call, run off the event loop)
+            self.pull_point_subscription = await asyncio.to_thread(
+                self.events_service.PullMessages,
                 SubscriptionReference={'Address': subscription_ref},
                 MessageLimit=10,
                 Timeout='PT30S'
@@ -79,8 +103,10 @@ class ONVIFEventSubscriber:
         while self.is_connected:
             try:
                 if self.pull_point_subscription:
-                    # Pull messages
-                    messages = self.events_service.PullMessages(
+                    # Pull messages; zeep blocks for up to the pull timeout, so run it
+                    # in a thread to let other cameras poll concurrently
+                    messages = await asyncio.to_thread(
+                        self.events_service.PullMessages,
                         SubscriptionReference=self.pull_point_subscription.SubscriptionReference,
                         MessageLimit=10,
                         Timeout='PT10S'
@@ -88,10 +114,10 @@ class ONVIFEventSubscriber:
 
                     if messages and messages.NotificationMessage:
                         for message in messages.NotificationMessage:
-                            # Check if it's a motion event
+                            # Check if it's a motion event (for cameras that ignore the filter)
                             topic = message.Topic._value_1 if hasattr(message.Topic, '_value_1') else str(message.Topic)
 
-                            if any(keyword in topic for keyword in ['Motion', 'motion', 'Alarm']):
+                            if _MOTION_RE.search(topic):
                                 logger.info(f"Motion detected on camera {self.camera_id}")
                                 await callback(self.camera_id, 'motion', message)
 
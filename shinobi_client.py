@@ -1,34 +1,57 @@
-import requests
-import json
+import httpx
 import asyncio
+import orjson
+import os
 from loguru import logger
 from urllib.parse import quote
 
+# Read size for recording downloads
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 class ShinobiClient:
+    # Monitor details shared by every camera we add
+    _DETAIL_TEMPLATE = {
+        'rtsp_transport': 'tcp',
+        'skip_ping': True,
+        'fatal_max': 10,
+        'detector': '1',
+        'detector_record_method': 'sip',
+        'detector_trigger': '1',
+        'detector_timeout': 10,
+        'record_method': 'all'
+    }
+
     def __init__(self, base_url, api_key, group_key):
         self.base_url = base_url.rstrip('/')
         self.api_key = api_key
         self.group_key = group_key
-        self.session = requests.Session()
 
-    def _make_request(self, method, endpoint, data=None, params=None):
-        """Make authenticated request to Shinobi API"""
-        url = "{}{}".format(self.base_url, endpoint)
+        # Endpoint prefixes; the keys are fixed for the client's lifetime
+        self._p_config = "/{}/configureMonitor/{}".format(api_key, group_key)
+        self._p_monitor = "/{}/monitor/{}".format(api_key, group_key)
+        self._p_motion = "/{}/motion/{}".format(api_key, group_key)
+        self._p_videos = "/{}/videos/{}".format(api_key, group_key)
+        self._p_probe = "/{}/probe/{}".format(api_key, group_key)
+        # Async client so requests for several monitors run concurrently over
+        # pooled (HTTP/2 when the server supports it) connections
+        self.session = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={'Content-Type': 'application/json'},
+            http2=True,
+            timeout=10.0,
+            limits=httpx.Limits(max_keepalive_connections=8)
+        )
 
-        headers = {
-            'Content-Type': 'application/json'
-        }
+    async def _make_request(self, method, endpoint, data=None, params=None):
+        """Make authenticated request to Shinobi API"""
+        method = method.upper()
+        if method not in ('GET', 'POST', 'DELETE'):
+            raise ValueError("Unsupported HTTP method: {}".format(method))
 
         try:
-            if method.upper() == 'GET':
-                response = self.session.get(url, headers=headers, params=params)
-            elif method.upper() == 'POST':
-                response = self.session.post(url, headers=headers, params=params, json=data)
-            elif method.upper() == 'DELETE':
-                response = self.session.delete(url, headers=headers, params=params)
-            else:
-                raise ValueError("Unsupported HTTP method: {}".format(method))
+            response = await self.session.request(method, endpoint, params=params,
+                                                  json=data if method == 'POST' else None)
 
             logger.debug("Request URL: {} | Method: {} | Status: {}".format(
                 response.url, method, response.status_code))
@@ -36,16 +59,16 @@ class ShinobiClient:
             response.raise_for_status()
             return response.json()
 
-        except requests.exceptions.RequestException as e:
-            logger.error("Shinobi API request failed: {} | URL: {}".format(e, url))
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error("Shinobi API request failed: {} | URL: {}{}".format(e, self.base_url, endpoint))
             return None
 
+    async def close(self):
+        """Close the pooled connections"""
+        await self.session.aclose()
+
     async def add_monitor(self, monitor_id, config):
-        endpoint = "/{}/configureMonitor/{}/{}".format(
-            self.api_key, 
-            self.group_key, 
-            monitor_id
-        )
+        endpoint = "{}/{}".format(self._p_config, monitor_id)
 
         monitor_config = {
             'mid': monitor_id,
@@ -57,24 +80,17 @@ class ShinobiClient:
             'port': str(config.get('port', 554)),
             'path': config.get('path', '/stream'),
             'mode': config.get('mode', 'record'),
-            'details': json.dumps({
-                'rtsp_transport': 'tcp',
-                'skip_ping': True,
-                'fatal_max': 10,
-                'detector': '1',
-                'detector_record_method': 'sip',
-                'detector_trigger': '1',
-                'detector_timeout': 10,
-                'record_method': 'all',
+            'details': orjson.dumps({
+                **self._DETAIL_TEMPLATE,
                 'recording_dir': './recordings/{}'.format(monitor_id)
-            })
+            }).decode()
         }
 
         params = {
-            'data': json.dumps(monitor_config)
+            'data': orjson.dumps(monitor_config).decode()
         }
 
-        result = self._make_request('POST', endpoint, params=params)
+        result = await self._make_request('POST', endpoint, params=params)
         if result and result.get('ok'):
             logger.info("Successfully added monitor {} to Shinobi".format(monitor_id))
             return True
@@ -83,14 +99,9 @@ class ShinobiClient:
             return False
 
     async def update_monitor_mode(self, monitor_id, mode):
-        endpoint = "/{}/monitor/{}/{}/{}".format(
-            self.api_key, 
-            self.group_key, 
-            monitor_id,
-            mode
-        )
+        endpoint = "{}/{}/{}".format(self._p_monitor, monitor_id, mode)
 
-        result = self._make_request('GET', endpoint)
+        result = await self._make_request('GET', endpoint)
         if result and result.get('ok'):
             logger.info("Successfully updated monitor {} mode to {}".format(monitor_id, mode))
             return True
@@ -99,11 +110,7 @@ class ShinobiClient:
             return False
 
     async def trigger_event_recording(self, monitor_id):
-        endpoint = "/{}/motion/{}/{}".format(
-            self.api_key, 
-            self.group_key, 
-            monitor_id
-        )
+        endpoint = "{}/{}".format(self._p_motion, monitor_id)
 
         trigger_data = {
             'plug': monitor_id,
@@ -113,10 +120,10 @@ class ShinobiClient:
         }
 
         params = {
-            'data': json.dumps(trigger_data)
+            'data': orjson.dumps(trigger_data).decode()
         }
 
-        result = self._make_request('GET', endpoint, params=params)
+        result = await self._make_request('GET', endpoint, params=params)
         if result and result.get('ok'):
             logger.info("Successfully triggered event recording for monitor {}".format(monitor_id))
             return True
@@ -125,9 +132,9 @@ class ShinobiClient:
             return False
 
     async def get_monitors(self):
-        endpoint = "/{}/monitor/{}".format(self.api_key, self.group_key)
+        endpoint = self._p_monitor
 
-        result = self._make_request('GET', endpoint)
+        result = await self._make_request('GET', endpoint)
         if result:
             return result
         else:
@@ -135,9 +142,9 @@ class ShinobiClient:
             return None
 
     async def get_monitor_status(self, monitor_id):
-        endpoint = "/{}/monitor/{}".format(self.api_key, self.group_key)
+        endpoint = self._p_monitor
 
-        result = self._make_request('GET', endpoint)
+        result = await self._make_request('GET', endpoint)
         if result:
             monitors = result if isinstance(result, list) else result.get('monitors', result)
             if isinstance(monitors, list):
@@ -151,13 +158,9 @@ class ShinobiClient:
             return None
 
     async def delete_monitor(self, monitor_id):
-        endpoint = "/{}/configureMonitor/{}/{}/delete".format(
-            self.api_key, 
-            self.group_key, 
-            monitor_id
-        )
+        endpoint = "{}/{}/delete".format(self._p_config, monitor_id)
 
-        result = self._make_request('GET', endpoint)
+        result = await self._make_request('GET', endpoint)
         if result and result.get('ok'):
             logger.info("Successfully deleted monitor {}".format(monitor_id))
             return True
@@ -166,11 +169,7 @@ class ShinobiClient:
             return False
 
     async def get_recordings(self, monitor_id, start_date=None, end_date=None):
-        endpoint = "/{}/videos/{}/{}".format(
-            self.api_key, 
-            self.group_key,
-            monitor_id
-        )
+        endpoint = "{}/{}".format(self._p_videos, monitor_id)
 
         params = {}
         if start_date:
@@ -178,7 +177,7 @@ class ShinobiClient:
         if end_date:
             params['end'] = end_date
 
-        result = self._make_request('GET', endpoint, params=params)
+        result = await self._make_request('GET', endpoint, params=params)
         if result:
             videos = result.get('videos', result) if isinstance(result, dict) else result
             return videos
@@ -187,23 +186,26 @@ class ShinobiClient:
             return None
 
     async def download_recording(self, monitor_id, filename, save_path):
-        endpoint = "/{}/videos/{}/{}/{}".format(
-            self.api_key, 
-            self.group_key, 
-            monitor_id,
-            filename
-        )
+        endpoint = "{}/{}/{}".format(self._p_videos, monitor_id, filename)
 
         try:
-            response = self.session.get(
-                "{}{}".format(self.base_url, endpoint),
-                stream=True
-            )
-            response.raise_for_status()
-
-            with open(save_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            async with self.session.stream('GET', endpoint) as response:
+                response.raise_for_status()
+
+                # Large reads written straight to an unbuffered fd
+                fd = os.open(save_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        view = memoryview(chunk)
+                        while view:
+                            view = view[os.write(fd, view):]
+
+                    # Archived downloads are rarely read back; keep them from
+                    # evicting the live recordings from the page cache
+                    if hasattr(os, 'posix_fadvise'):
+                        await asyncio.to_thread(self._drop_page_cache, fd)
+                finally:
+                    os.close(fd)
 
             logger.info("Successfully downloaded recording {} to {}".format(filename, save_path))
             return True
@@ -212,15 +214,21 @@ class ShinobiClient:
             logger.error("Failed to download recording {}: {}".format(filename, e))
             return False
 
+    @staticmethod
+    def _drop_page_cache(fd):
+        """Write a finished download back and drop it from the page cache"""
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
     async def probe_camera(self, rtsp_url):
-        endpoint = "/{}/probe/{}".format(self.api_key, self.group_key)
+        endpoint = self._p_probe
         
         params = {
             'url': rtsp_url,
             'flags': 'default'
         }
 
-        result = self._make_request('GET', endpoint, params=params)
+        result = await self._make_request('GET', endpoint, params=params)
         if result:
             logger.info("Successfully probed camera URL")
             return result
@@ -4,37 +4,94 @@ Test script to verify camera server setup and configuration.
 Run this before starting the camera server to ensure everything is configured correctly.
 """
 
-import json
+import hashlib
 import os
+import stat
 import sys
-import importlib
-import onvif
-def check_dependencies():
-    """Check if all required Python packages are installed"""
+import time
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import ModuleType
+from typing import TYPE_CHECKING, Optional, Tuple, Type
+
+if TYPE_CHECKING:
+    from config_schema import AppConfig
+
+# orjson when available; the setup check must also run before it is installed.
+# Both provide loads/dumps/JSONDecodeError.
+_json: ModuleType
+try:
+    import orjson
+    _json = orjson
+except ImportError:
+    import json
+    _json = json
+
+# pip package -> module name for every required dependency
+REQUIRED_MODULES = {
+    "requests": "requests",
+    "httpx": "httpx",
+    "h2": "h2",                # httpx[http2]; ShinobiClient opens an HTTP/2 client
+    "opencv-python": "cv2",
+    "numpy": "numpy",
+    "onvif-zeep": "onvif",     # <-- FIXED HERE
+    "asyncio": "asyncio",
+    "aiohttp": "aiohttp",
+    "pydantic": "pydantic",
+    "loguru": "loguru",
+    "orjson": "orjson",
+}
+
+# Reported when missing, but the server runs without them (see SETUP_GUIDE.md)
+OPTIONAL_MODULES = {
+    "gstreamer-python": "gi",
+}
+
+# Top-level sections and the keys each config section must define
+REQUIRED_SECTIONS = frozenset({'shinobi', 'cameras', 'recording', 'server'})
+REQUIRED_SHINOBI = frozenset({'base_url', 'api_key', 'group_key'})
+REQUIRED_CAMERA = frozenset({'id', 'name', 'rtsp_url', 'onvif_url', 'username', 'password'})
+REQUIRED_RECORDING = frozenset({'base_dir', 'segment_duration', 'pre_event_buffer', 'post_event_duration'})
+
+# Written next to config.json once it validates; an unchanged config skips validation
+CONFIG_CACHE_NAME = '.config.cache.json'
+# Bump whenever the checks change, so configs validated by older checks are re-validated
+CONFIG_SCHEMA_VERSION = 1
+
+def _present(module_name: str) -> bool:
+    """True if a module is importable, without executing it"""
+    # Already imported (e.g. by a harness calling this repeatedly): no path walk
+    if module_name in sys.modules:
+        return True
+    return importlib.util.find_spec(module_name) is not None
 
-    required_modules = {
-        "requests": "requests",
-        "opencv-python": "cv2",
-        "gstreamer-python": "gi",
-        "onvif-zeep": "onvif",     # <-- FIXED HERE
-        "asyncio": "asyncio",
-        "aiohttp": "aiohttp",
-        "pydantic": "pydantic",
-        "loguru": "loguru",
-    }
 
+def check_dependencies() -> bool:
+    """Check if all required Python packages are installed"""
     missing = []
 
     print(" Checking dependencies...")
 
-    for pip_name, module_name in required_modules.items():
-        try:
-            importlib.import_module(module_name)
+    # find_spec only locates the module; importing cv2/gi/onvif runs their heavy init.
+    # Each probe walks sys.path, so probe all of them at once
+    modules = {**REQUIRED_MODULES, **OPTIONAL_MODULES}
+    with ThreadPoolExecutor(max_workers=min(8, len(modules))) as ex:
+        present = dict(zip(modules, ex.map(_present, modules.values())))
+
+    for pip_name, module_name in REQUIRED_MODULES.items():
+        if present[pip_name]:
             print(module_name)
-        except ImportError:
+        else:
             print(f"Missing: {pip_name}")
             missing.append(pip_name)
 
+    for pip_name, module_name in OPTIONAL_MODULES.items():
+        if present[pip_name]:
+            print(module_name)
+        else:
+            print(f"Optional, not installed: {pip_name}")
+
     if missing:
         print("\n Missing packages:", ", ".join(missing))
         print("Run: pip install -r requirements.txt\n")
@@ -43,35 +100,116 @@ def check_dependencies():
     return True
 
 
-def check_config():
-    """Check if config.json is valid and complete"""
-    config_path = 'config.json'
-
-    if not os.path.exists(config_path):
+def load_config(config_path: str = 'config.json') -> Optional[Tuple[dict, bytes]]:
+    """Load config.json once for all checks as (config, raw bytes); None if it is missing or invalid"""
+    try:
+        with open(config_path, 'rb') as f:
+            raw = f.read()
+        return _json.loads(raw), raw
+    except FileNotFoundError:
         print(f" Config file not found: {config_path}")
+        return None
+    except _json.JSONDecodeError as e:
+        print(f" Invalid JSON in config file: {e}")
+        return None
+
+
+@lru_cache(maxsize=1)
+def _config_model() -> Optional[Type['AppConfig']]:
+    """The pydantic schema for config.json, or None if pydantic is not installed"""
+    # Imported on first use; pydantic is slow to import and may be missing
+    try:
+        from config_schema import AppConfig
+    except ImportError:
+        return None
+    return AppConfig
+
+
+def _config_cache_path(config_path: str) -> str:
+    return os.path.join(os.path.dirname(config_path), CONFIG_CACHE_NAME)
+
+
+def _config_cache_key(raw: bytes) -> dict:
+    """Identify a config file's contents and the checks that validate it"""
+    return {
+        'sha1': hashlib.sha1(raw).hexdigest(),
+        'schema': CONFIG_SCHEMA_VERSION,
+        # Installing (or removing) pydantic changes how strictly the config is checked.
+        # Only locate it: importing it and building the schema costs far more than
+        # the validation a cache hit skips.
+        'validator': 'pydantic' if _present('pydantic') else 'fields'
+    }
+
+
+def _config_cache_hit(config_path: str, key: dict) -> bool:
+    """True if the cache records these exact contents as validated by these checks"""
+    try:
+        with open(_config_cache_path(config_path), 'rb') as f:
+            cached = _json.loads(f.read())
+    except (OSError, ValueError):
+        return False
+    return isinstance(cached, dict) and all(cached.get(k) == v for k, v in key.items())
+
+
+def _write_config_cache(config_path: str, key: dict) -> None:
+    """Record a validated config; failures only cost a re-validation next time"""
+    data = _json.dumps({**key, 'validated_at': time.time()})
+    if isinstance(data, str):  # json fallback
+        data = data.encode()
+    try:
+        with open(_config_cache_path(config_path), 'wb') as f:
+            f.write(data)
+    except OSError:
+        pass
+
+
+def check_config_file(config: dict, raw: bytes, config_path: str = 'config.json') -> bool:
+    """Validate a loaded config, skipping it if these exact bytes already passed"""
+    key = _config_cache_key(raw)
+    if _config_cache_hit(config_path, key):
+        return True
+
+    # Invalid configs are never cached
+    if not check_config(config):
         return False
+    _write_config_cache(config_path, key)
+    return True
+
+
+def check_config(config: dict) -> bool:
+    """Check if config.json is valid and complete"""
+    model = _config_model()
+    if model is None:
+        return _check_config_fields(config)
 
     try:
-        with open(config_path, 'r') as f:
-            config = json.load(f)
-    except json.JSONDecodeError as e:
-        #print(f" Invalid JSON in config file: {e}")
+        model.model_validate(config)
+    except ValueError as e:
+        # pydantic's ValidationError lists every invalid field with its path
+        print(f" Invalid configuration: {e}")
         return False
 
+    return True
+
+
+def _camera_ok(camera: dict) -> bool:
+    """True if a camera defines every required field with a non-empty value"""
+    return all(camera.get(key) for key in REQUIRED_CAMERA)
+
+
+def _check_config_fields(config: dict) -> bool:
+    """Validate config.json by hand when pydantic is not installed"""
     # Check required sections
-    required_sections = ['shinobi', 'cameras', 'recording', 'server']
-    for section in required_sections:
-        if section not in config:
-           # print(f" Missing section in config: {section}")
-            return False
+    if not REQUIRED_SECTIONS.issubset(config):
+        print(f" Missing section in config: {', '.join(sorted(REQUIRED_SECTIONS - config.keys()))}")
+        return False
 
     # Check Shinobi config
     shinobi = config['shinobi']
-    required_shinobi_keys = ['base_url', 'api_key', 'group_key']
-    for key in required_shinobi_keys:
-        if key not in shinobi or not shinobi[key]:
-            print(f" Missing or empty Shinobi config: {key}")
-            return False
+    bad = [key for key in REQUIRED_SHINOBI if not shinobi.get(key)]
+    if bad:
+        print(f" Missing or empty Shinobi config: {', '.join(sorted(bad))}")
+        return False
 
     # Check cameras
     cameras = config['cameras']
@@ -79,43 +217,41 @@ def check_config():
         print(" No cameras configured")
         return False
 
-    for i, camera in enumerate(cameras):
-        required_camera_keys = ['id', 'name', 'rtsp_url', 'onvif_url', 'username', 'password']
-        for key in required_camera_keys:
-            if key not in camera or not camera[key]:
-                print(f" Camera {i+1}: Missing or empty field: {key}")
-                return False
+    # Stops at the first bad camera; its fields are only listed for the message
+    i = next((i for i, camera in enumerate(cameras) if not _camera_ok(camera)), None)
+    if i is not None:
+        bad = sorted(key for key in REQUIRED_CAMERA if not cameras[i].get(key))
+        print(f" Camera {i+1}: Missing or empty field: {', '.join(bad)}")
+        return False
 
     # Check recording config
     recording = config['recording']
-    required_recording_keys = ['base_dir', 'segment_duration', 'pre_event_buffer', 'post_event_duration']
-    for key in required_recording_keys:
-        if key not in recording:
-            print(f" Missing recording config: {key}")
-            return False
+    missing = REQUIRED_RECORDING - recording.keys()
+    if missing:
+        print(f" Missing recording config: {', '.join(sorted(missing))}")
+        return False
 
    # print(" Configuration is valid!")
     return True
 
-def check_directories():
+def check_directories(config: dict) -> bool:
     """Check if required directories exist and are writable"""
-    config_path = 'config.json'
-
-    try:
-        with open(config_path, 'r') as f:
-            config = json.load(f)
-    except:
-        return False
-
     recording_dir = config['recording']['base_dir']
 
     try:
-        os.makedirs(recording_dir, exist_ok=True)
-        # Test write permission
-        test_file = os.path.join(recording_dir, 'test_write.tmp')
-        with open(test_file, 'w') as f:
-            f.write('test')
-        os.remove(test_file)
+        # One stat answers both "does it exist" and "is it a directory";
+        # makedirs is only needed on first setup
+        try:
+            if not stat.S_ISDIR(os.stat(recording_dir).st_mode):
+                print(f" Recording path is not a directory: {recording_dir}")
+                return False
+        except FileNotFoundError:
+            os.makedirs(recording_dir)
+
+        # Permission check without creating and deleting a probe file
+        if not os.access(recording_dir, os.W_OK):
+            print(f" Recording directory is not writable: {recording_dir}")
+            return False
 
         print(f" Recording directory is writable: {recording_dir}")
         return True
@@ -123,32 +259,41 @@ def check_directories():
         print(f" Cannot create/write to recording directory: {e}")
         return False
 
-def main():
+def main() -> None:
     """Run all setup checks"""
    # print(" Checking Camera Server Setup...\n")
 
-    all_good = True
+    config: Optional[dict] = None
+
+    def check_configuration() -> bool:
+        nonlocal config
+        loaded = load_config()
+        if loaded is None:
+            return False
+        config, raw = loaded
+        return check_config_file(config, raw)
 
+    # Missing packages don't stop the config checks (the hand-written validator
+    # covers a missing pydantic), but the directories need a valid config
     print(" Checking dependencies...")
-    if not check_dependencies():
-        all_good = False
+    all_good = check_dependencies()
 
     print("\n  Checking configuration...")
-    if not check_config():
-        all_good = False
-
-    print("\n Checking directories...")
-    if not check_directories():
+    if check_configuration():
+        print("\n Checking directories...")
+        if config is None or not check_directories(config):
+            all_good = False
+    else:
         all_good = False
 
-    print("\n" + "="*50)
-
-    if all_good:
-        print("Setup check passed! You can now run the camera server:")
-        print("   python camera_server.py")
-    else:
+    if not all_good:
+        print("\n" + "="*50)
         print(" Setup check failed. Please fix the issues above.")
         sys.exit(1)
 
+    print("\n" + "="*50)
+    print("Setup check passed! You can now run the camera server:")
+    print("   python camera_server.py")
+
 if __name__ == "__main__":
     main()
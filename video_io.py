@@ -0,0 +1,344 @@
+import math
+import os
+import shutil
+import subprocess
+from functools import lru_cache
+
+import cv2
+from loguru import logger
+
+try:
+    import av
+except ImportError:
+    av = None
+
+# Preferred encoders, fastest hardware first; libx264 is the software fallback
+ENCODER_PRIORITY = ['h264_nvenc', 'h264_qsv', 'h264_vaapi', 'h264_v4l2m2m', 'libx264']
+
+VAAPI_DEVICE = '/dev/dri/renderD128'
+
+# Fallback codec when no ffmpeg encoder is available
+_FOURCC_MP4V = cv2.VideoWriter_fourcc(*'mp4v')
+
+# Low-latency RTSP demuxing: no FFmpeg lookahead or reordering buffer
+FFMPEG_CAPTURE_OPTIONS = 'rtsp_transport;tcp|fflags;nobuffer|flags;low_delay|max_delay;0|reorder_queue_size;0'
+
+
+# Pre-event dumps are encoded as fast as possible: no B-frames, short GOP
+_EVENT_GOP_ARGS = ['-bf', '0', '-g', '15']
+
+
+def _encoder_args(encoder, profile='continuous'):
+    """Build the ffmpeg output arguments for the given encoder and profile"""
+    # 'continuous' favours compression; 'event' favours encode speed for pre-event dumps
+    event = profile == 'event'
+    if encoder == 'h264_nvenc':
+        if event:
+            return ['-c:v', encoder, '-preset', 'p1', '-tune', 'ull', *_EVENT_GOP_ARGS]
+        return ['-c:v', encoder, '-preset', 'p4', '-tune', 'll']
+    if encoder == 'h264_qsv':
+        return ['-c:v', encoder, '-preset', 'veryfast', *(_EVENT_GOP_ARGS if event else [])]
+    if encoder == 'h264_vaapi':
+        return ['-vf', 'format=nv12,hwupload', '-c:v', encoder, *(_EVENT_GOP_ARGS if event else [])]
+    if encoder == 'h264_v4l2m2m':
+        return ['-pix_fmt', 'yuv420p', '-c:v', encoder]
+    if event:
+        return ['-c:v', encoder, '-preset', 'ultrafast', '-tune', 'zerolatency', *_EVENT_GOP_ARGS,
+                '-pix_fmt', 'yuv420p']
+    return ['-c:v', encoder, '-preset', 'medium', '-tune', 'film', '-bf', '3', '-pix_fmt', 'yuv420p']
+
+
+def _input_args(encoder):
+    """Build the ffmpeg global arguments needed before the input"""
+    if encoder == 'h264_vaapi':
+        return ['-vaapi_device', VAAPI_DEVICE]
+    return []
+
+
+def _encoder_works(encoder):
+    """Encode a single test frame to check the encoder is usable on this host"""
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', *_input_args(encoder),
+           '-f', 'lavfi', '-i', 'color=black:s=256x256', '-frames:v', '1',
+           *_encoder_args(encoder), '-f', 'null', '-']
+    try:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              timeout=10).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+@lru_cache(maxsize=1)
+def probe_encoder():
+    """Return the best available H.264 encoder, or None if ffmpeg is not installed"""
+    if shutil.which('ffmpeg') is None:
+        logger.warning("ffmpeg not found, falling back to OpenCV mp4v encoding")
+        return None
+
+    try:
+        output = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"Failed to list ffmpeg encoders: {e}")
+        return None
+
+    listed = {line.split()[1] for line in output.splitlines() if len(line.split()) > 1}
+    for encoder in ENCODER_PRIORITY:
+        # ffmpeg lists hardware encoders even when no device is present
+        if encoder in listed and _encoder_works(encoder):
+            logger.info(f"Using ffmpeg encoder: {encoder}")
+            return encoder
+
+    logger.warning("No usable ffmpeg H.264 encoder found, falling back to OpenCV mp4v encoding")
+    return None
+
+
+class HWVideoWriter:
+    """cv2.VideoWriter-compatible writer that pipes raw BGR frames into ffmpeg"""
+
+    def __init__(self, path, fps, frame_size, encoder, bitrate='4M', profile='continuous'):
+        self.path = path
+        width, height = frame_size
+        cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', *_input_args(encoder),
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}',
+               '-r', str(fps), '-i', '-',
+               *_encoder_args(encoder, profile), '-b:v', bitrate,
+               '-movflags', '+faststart', '-f', 'mp4', path]
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        except OSError as e:
+            logger.error(f"Failed to start ffmpeg for {path}: {e}")
+            self.proc = None
+
+    def isOpened(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def write(self, frame):
+        """Write one BGR frame; frame.data avoids a copy for contiguous arrays"""
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.write(frame.data if frame.flags['C_CONTIGUOUS'] else frame.tobytes())
+        except (BrokenPipeError, ValueError):
+            logger.error(f"ffmpeg exited unexpectedly while writing {self.path}")
+            self.release()
+
+    def release(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.proc.wait() != 0:
+            logger.error(f"ffmpeg exited with code {self.proc.returncode} for {self.path}")
+        self.proc = None
+
+
+# open_video_writer's default: probe for the encoder in this process
+_PROBE = object()
+
+
+def open_video_writer(path, fps, frame_size, bitrate='4M', profile='continuous', encoder=_PROBE):
+    """Open a hardware-accelerated writer when possible, else an OpenCV mp4v writer"""
+    # Worker processes pass the encoder their parent already probed (None = OpenCV),
+    # since probe_encoder's cache doesn't cross process boundaries
+    if encoder is _PROBE:
+        encoder = probe_encoder()
+    if encoder is not None:
+        return HWVideoWriter(path, fps, frame_size, encoder, bitrate, profile)
+
+    return cv2.VideoWriter(path, _FOURCC_MP4V, fps, frame_size)
+
+
+class RollingSegmentCache:
+    """Keeps the last few seconds of a stream on disk as stream-copied ffmpeg segments"""
+
+    def __init__(self, rtsp_url, cache_dir, history_seconds, segment_seconds=10):
+        self.rtsp_url = rtsp_url
+        # Absolute, since ffmpeg's concat demuxer resolves relative list entries
+        # against the list file's directory rather than the working directory
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.segment_seconds = segment_seconds
+        # Enough segments for the history, plus the one being written and one spare
+        # so a segment isn't overwritten while it is being exported
+        self.wrap = math.ceil(history_seconds / segment_seconds) + 2
+        self.proc = None
+
+    def start(self):
+        """Start (or restart) the ffmpeg segmenter; frames never enter Python"""
+        if self.is_running():
+            return True
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if self.rtsp_url.lower().startswith(('rtsp://', 'rtsps://')):
+            input_args = ['-rtsp_transport', 'tcp']
+        else:
+            # Other sources (files) are read at their native rate, like the reader does
+            input_args = ['-re']
+        # MPEG-TS segments stay readable while ffmpeg is still writing them
+        cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', *input_args,
+               '-i', self.rtsp_url, '-map', '0:v', '-c', 'copy',
+               '-f', 'segment', '-segment_time', str(self.segment_seconds),
+               '-segment_wrap', str(self.wrap), '-segment_format', 'mpegts',
+               '-reset_timestamps', '1', os.path.join(self.cache_dir, '%03d.ts')]
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL)
+            return True
+        except OSError as e:
+            logger.error(f"Failed to start segment cache for {self.cache_dir}: {e}")
+            return False
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def stop(self):
+        if self.proc is None:
+            return
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    def export(self, start_time, out_path):
+        """Stream-copy the cached segments written since start_time into one mp4"""
+        # A segment's mtime is its last write, so it overlaps the window if newer than start_time
+        segments = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(self.cache_dir)
+                          if entry.name.endswith('.ts'))
+        wanted = [path for mtime, path in segments if mtime >= start_time]
+        if not wanted:
+            logger.warning(f"No cached segments since {start_time} in {self.cache_dir}")
+            return False
+
+        list_path = out_path + '.txt'
+        with open(list_path, 'w') as f:
+            for path in wanted:
+                escaped = path.replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-f', 'concat', '-safe', '0',
+               '-i', list_path, '-c', 'copy', '-movflags', '+faststart', out_path]
+        try:
+            result = subprocess.run(cmd, stdin=subprocess.DEVNULL, timeout=60)
+            if result.returncode != 0:
+                logger.error(f"ffmpeg concat failed with code {result.returncode} for {out_path}")
+            return result.returncode == 0
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error(f"ffmpeg concat failed for {out_path}: {e}")
+            return False
+        finally:
+            os.remove(list_path)
+
+
+def drop_page_cache(path):
+    """Flush a finished recording and evict it from the page cache (Linux only)"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            # DONTNEED only drops clean pages, so write the file back first
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.warning(f"Failed to drop page cache for {path}: {e}")
+
+
+class PyAVCapture:
+    """cv2.VideoCapture-compatible reader that decodes with PyAV, on the GPU when available"""
+
+    def __init__(self, url, hwaccel=None):
+        self.url = url
+        self.container = None
+        self.stream = None
+        self._frames = None
+        # Same low-latency demuxer options as the OpenCV path
+        options = dict(item.split(';', 1) for item in FFMPEG_CAPTURE_OPTIONS.split('|'))
+        try:
+            hw_args = self._hwaccel_args(hwaccel)
+            try:
+                self.container = av.open(url, options=options, timeout=10, **hw_args)
+            except (av.error.FFmpegError, OSError) as e:
+                if not hw_args:
+                    raise
+                # Device listed by FFmpeg but unusable here (no GPU, no permissions)
+                logger.warning(f"Hardware decoder '{hwaccel}' failed for {url} ({e}), decoding in software")
+                self.container = av.open(url, options=options, timeout=10)
+            self.stream = self.container.streams.video[0]
+            self.stream.thread_type = 'AUTO'
+            self._frames = self.container.decode(self.stream)
+        except (av.error.FFmpegError, OSError, IndexError) as e:
+            logger.error(f"PyAV failed to open {url}: {e}")
+            self.release()
+
+    @staticmethod
+    def _hwaccel_args(hwaccel):
+        """Build the av.open() hardware decoding argument, if this PyAV/FFmpeg supports it"""
+        if not hwaccel:
+            return {}
+        if not hasattr(av.codec, 'hwaccel'):
+            logger.warning(f"PyAV {av.__version__} has no hardware decoding support, decoding in software")
+            return {}
+        if hwaccel not in av.codec.hwaccel.hwdevices_available():
+            logger.warning(f"Hardware decoder '{hwaccel}' not available, decoding in software")
+            return {}
+        return {'hwaccel': av.codec.hwaccel.HWAccel(device_type=hwaccel, allow_software_fallback=True)}
+
+    def isOpened(self):
+        return self._frames is not None
+
+    def read(self):
+        """Decode the next frame as a BGR array, returning (ok, frame) like cv2.VideoCapture"""
+        if self._frames is None:
+            return False, None
+        try:
+            frame = next(self._frames)
+        except StopIteration:
+            return False, None
+        except (av.error.FFmpegError, OSError) as e:
+            logger.warning(f"PyAV failed to decode {self.url}: {e}")
+            return False, None
+        return True, frame.to_ndarray(format='bgr24')
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS and self.stream is not None and self.stream.average_rate:
+            return float(self.stream.average_rate)
+        return 0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        if self.container is not None:
+            self.container.close()
+        self.container = None
+        self._frames = None
+
+
+def open_video_capture(url, decoder='opencv', hwaccel=None):
+    """Open an RTSP stream with FFmpeg, requesting hardware decoding when OpenCV supports it"""
+    # decoder 'pyav' decodes through PyAV with the given hwaccel device type
+    # (e.g. 'cuda', 'vaapi', 'qsv'), falling back to OpenCV if that fails
+    if decoder == 'pyav':
+        if av is None:
+            logger.warning("PyAV is not installed, falling back to OpenCV decoding")
+        else:
+            cap = PyAVCapture(url, hwaccel)
+            if cap.isOpened():
+                return cap
+            logger.warning(f"Falling back to OpenCV decoding for {url}")
+
+    # Read by OpenCV when the capture is opened; an explicit user setting wins
+    os.environ.setdefault('OPENCV_FFMPEG_CAPTURE_OPTIONS', FFMPEG_CAPTURE_OPTIONS)
+
+    if hasattr(cv2, 'CAP_PROP_HW_ACCELERATION'):
+        cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG,
+                               [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+    else:
+        cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
+
+    # Keep only the newest decoded frame instead of OpenCV's default 4-frame queue
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap